@@ -7,6 +7,7 @@
 import torch
 from torch.utils.data import Dataset
 from anndata import AnnData
+from typing import Optional
 from scipy.sparse import issparse
 import numpy as np
 
@@ -14,31 +15,50 @@ class EntropyDataset(Dataset):
     """
     EntropyDataset
     fafaf
-    A Dataloader for anndata objects
+    A Dataloader for anndata objects, each item is a dense batch of
+    consecutive cells so sparse rows are densified a block at a time.
     
     Params
     -------
     adata
         Annotated dataset comprising a preprocessed dataset to compute entropy on.
+    batch_size
+        Number of cells in each item, defaults to all cells.
+    max_dense_bytes
+        Sparse matrices whose dense form takes at most this many bytes
+        are densified once up front instead of block by block.
+    pad
+        Whether to zero-pad the final block to batch_size cells so that
+        every item has the same shape.
     """
     
-    def __init__(self, adata : AnnData):
+    def __init__(self, adata : AnnData, batch_size : Optional[int] = None, max_dense_bytes : int = 2**30,
+                 pad : bool = False):
         self.data = adata.X
+        self.pad = pad
+        
+        # Densify once if the whole dense matrix is small enough
+        dense_bytes = np.prod(self.data.shape, dtype = np.int64) * self.data.dtype.itemsize
+        if issparse(self.data) and dense_bytes <= max_dense_bytes:
+            self.data = self.data.toarray()
+        
+        self.batch_size = batch_size if batch_size else self.data.shape[0]
                 
     def __len__(self):
-        return self.data.shape[0]
+        return int(np.ceil(self.data.shape[0] / self.batch_size))
     
     def __getitem__(self, idx):
         
-        # Get vector at index
-        exp = self.data[idx]
+        # Get block of cells at index
+        exp = self.data[idx * self.batch_size : (idx + 1) * self.batch_size]
         
         # convert from sparse to dense if desired
-        exp = exp.toarray() if issparse(exp) else exp
+        exp = exp.toarray() if issparse(exp) else np.asarray(exp)
         
-        # Flatten
-        exp = exp.flatten()
+        # Pad final block with empty cells to keep a fixed shape
+        if self.pad and exp.shape[0] < self.batch_size:
+            exp = np.pad(exp, ((0, self.batch_size - exp.shape[0]), (0, 0)))
         
         # Cast to tensor and yield
-        return torch.tensor(exp)
+        return torch.from_numpy(exp)
         
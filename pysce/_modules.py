@@ -15,46 +15,73 @@ class EntropyModule(torch.nn.Module):
     
     Params
     -------
+    ppi
+        The PPI as a sparse COO tensor, its edge list is stored as buffers
+        so it moves with the module and is not passed in on every batch.
+    max_entropy
+        Maximum entropy of the PPI used to normalize scores.
     
     """
-    def __init__(self):
+    def __init__(self, ppi : torch.tensor, max_entropy : float):
         super().__init__()
         
+        # Edge list of the PPI, (row, col) indices of shape (2, edges) and their values,
+        # indices are stored as int32 when they fit to halve their memory
+        ppi = ppi.coalesce()  # no copy if already coalesced
+        ppi_index = ppi.indices()
+        ppi_index = ppi_index.to(torch.int32) if max(ppi.shape) < 2**31 else ppi_index
+        self.register_buffer('ppi_index', ppi_index)
+        self.register_buffer('ppi_weight', ppi.values())
+        self.max_entropy = max_entropy
+        
     @torch.compile
     def forward(self, 
         exp : torch.tensor, 
-        ppi : torch.tensor,
-        max_entropy : float, 
         expand : bool = False
         ) -> torch.tensor:
         """\
         Forward Function To Calculate Entropy Score
         
+        Only the nonzero edges of the PPI are visited.
+        
         """
         
         # If batch size is 1 and expression is a vector then expand dimensions
         exp = exp.unsqueeze(0) if expand else exp
 
-        # Transpose expression tensor to shape (genes, batch_size)
-        exp = exp.t()
+        # Unpack edge list of the PPI, expression stays in shape (batch_size, genes)
+        # and is gathered along the gene axis so no transposed copy is made
+        rows, cols = self.ppi_index[0], self.ppi_index[1]
+        weight = self.ppi_weight
+        
+        # Edge products run in the input precision, which may be reduced (e.g. bfloat16),
+        # while sums, logs and the entropy reduction are accumulated in float32
+        zeros = torch.zeros(exp.shape, dtype = torch.float32, device = exp.device)
+
+        # Gather expression at both ends of every edge, shape (batch_size, edges)
+        exp_rows, exp_cols = exp.index_select(1, rows), exp.index_select(1, cols)
 
         # Calculate stationary distribution used later when computing
-        # the final Markov chain entropy
-        m_exp = exp * torch.matmul(ppi, exp)
-        m_exp = m_exp / m_exp.sum(0)
-
-        # Map cell expression onto the PPI
-        pm = ppi * (exp.unsqueeze(0).permute([2, 1, 0]) * exp.unsqueeze(0).permute([2, 0, 1]))
+        # the final Markov chain entropy, ppi @ exp is summed over edges
+        m_exp = exp.float() * zeros.index_add(1, rows, (weight * exp_cols).float())
+        m_exp = m_exp / m_exp.sum(1, keepdim = True)
 
-        # Normalize each column to create a markov chain
-        pm = torch.nan_to_num(pm / pm.sum(1, keepdim = True))
+        # Map cell expression onto the PPI edges, shape (batch_size, edges)
+        pm = (weight * exp_rows * exp_cols).float()
+        
+        # Column sums used to normalize each column into a markov chain
+        pm_sum = zeros.index_add(1, cols, pm)
 
-        # Calculate entropy score
-        entropy = -torch.sum(torch.nan_to_num(pm.log() * pm), 1, keepdim = True)
-        entropy = torch.reshape(entropy, shape = [entropy.shape[0], entropy.shape[2]]).t()
-        entropy = torch.sum(m_exp * entropy, 0, keepdim = True)
+        # Calculate entropy score of each column, shape (batch_size, genes), as
+        # log(s) - sum(p * log(p)) / s so the normalized chain is never materialized,
+        # p * log(p) is taken as 0 where p is 0 and empty columns score 0, the column
+        # sum is clamped so neither branch of the mask produces non-finite values
+        entropy = zeros.index_add(1, cols, torch.xlogy(pm, pm))
+        pm_sum_safe = pm_sum.clamp_min(torch.finfo(pm_sum.dtype).tiny)
+        entropy = torch.where(pm_sum > 0, pm_sum_safe.log() - entropy / pm_sum_safe, 0.0)
+        entropy = torch.sum(m_exp * entropy, 1)
 
         # Normalize entropy
-        entropy = torch.squeeze(entropy / max_entropy)
+        entropy = torch.squeeze(entropy / self.max_entropy)
 
         return entropy
@@ -6,7 +6,7 @@
 
 from typing import Union, Tuple, Optional
 
-from ._utils import load_ppi, preprocess, calc_max_entropy, chunk
+from ._utils import load_ppi, preprocess, ppi_max_entropy, spmatrix_to_sparsetensor, get_device, get_batch_size, chunk
 from ._dataloaders import EntropyDataset
 from ._modules import EntropyModule
 
@@ -30,6 +30,8 @@ def score(
     artifact_genes = ('RPS','RPL','MT'),
     inplace : bool = True,
     layer : Optional[str] = None,
+    precision : str = 'float32',
+    num_workers : int = 0,
 ) -> Optional[AnnData]:
     """
     Score Entropy
@@ -42,13 +44,15 @@ def score(
         Annotated dataset comprising a preprocessed dataset to compute entropy on.
         Can also be a dataframe.
     ppi
-        The ppi network to use, currently only 'scent' is supported.
+        The ppi network to use, currently only 'scent' is supported. Loaded
+        networks are cached and shared between calls.
     use_raw
         Whether to use 'adata.raw' for counts source.
     batch_size
         Size of batch to compute entropy with, default is 8 cells. If you experiences
         out of memory errors, try decreasing this value. Increase this value to increase
-        GPU utilization, but note memory issues may arise.
+        GPU utilization, but note memory issues may arise. If None, the batch size is
+        estimated from free GPU memory.
     key_added
         The key in 'adata.obs' to add with entropy values computed.
     artifact_genes
@@ -57,6 +61,13 @@ def score(
         Compute changes to data inplace
     layer
         Whether to get counts source from a layer in data.
+    precision
+        Precision of expression values and PPI weights on device, one of 'float32',
+        'bfloat16' or 'float16'. Reduced precision halves memory traffic, entropy
+        is still accumulated in float32.
+    num_workers
+        Number of worker processes densifying batches in parallel with scoring,
+        default is 0 which densifies batches in the main process.
         
     Returns
     -------
@@ -68,6 +79,8 @@ def score(
     assert isinstance(data, (AnnData, pd.DataFrame)), "Input data must be AnnData or DataFrame object."
     assert ppi == 'scent', "PPI must be scent"
     assert batch_size >= 1 if batch_size else True, "Batch size must be >= 1 or None (auto-calculate)"
+    assert precision in ('float32', 'bfloat16', 'float16'), "Precision must be float32, bfloat16 or float16"
+    assert num_workers >= 0, "Number of workers must be >= 0"
     
     # Create a reference to the original data object
     data_orig = data
@@ -82,38 +95,56 @@ def score(
     else:
         data = AnnData(data.layers[layer], obs = data.obs, var = data.var)
     
-    # Remove artifact genes
-    data = data[:, data.var[~data.var.index.str.startswith(artifact_genes)].index] if artifact_genes else data
+    # Remove artifact genes, matching each prefix across all gene names at once
+    if artifact_genes:
+        names = data.var_names.to_numpy().astype(str)
+        artifact = np.zeros(len(names), dtype = bool)
+        prefixes = (artifact_genes,) if isinstance(artifact_genes, str) else tuple(artifact_genes)
+        for prefix in prefixes:
+            artifact |= np.char.startswith(names, prefix)
+        data = data[:, ~artifact]
 
     # Load PPI using provided name
-    ppi = load_ppi(ppi)
+    ppi_name = ppi
+    ppi = load_ppi(ppi_name)
     
     # Preprocess data, PPI, and calculate maximum entropy
     data, ppi = preprocess(data, ppi)
     
     # Calculate maximum entropy as log of right real eigenvalue
-    max_entropy = calc_max_entropy(ppi)
+    max_entropy = ppi_max_entropy(ppi_name, ppi)
     
     # setting device on GPU if available, else CPU
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    device = get_device()
+    
+    # Estimate batch size from free device memory if not provided
+    batch_size = batch_size if batch_size else get_batch_size(ppi.n_vars, ppi.X.nnz, device)
+    batch_size = min(batch_size, data.n_obs)
+    
+    # Even out batches so padding the final one adds fewer cells than there are batches
+    batch_size = int(np.ceil(data.n_obs / np.ceil(data.n_obs / batch_size)))
 
-    # Get dataset
-    dataset = EntropyDataset(data)
+    # Get dataset, batches are densified block-wise by the dataset itself and
+    # the final batch is padded so the compiled module only sees one shape
+    dataset = EntropyDataset(data, batch_size, pad = True)
 
-    # Create dataloader
-    dataloader = DataLoader(dataset, batch_size = batch_size)
+    # Create dataloader, pinned host memory allows asynchronous copies to the GPU
+    # and workers densify upcoming batches while the current one is scored
+    dataloader = DataLoader(dataset, batch_size = None, pin_memory = device.type == 'cuda',
+                            num_workers = num_workers)
     
-    # Create entropy module
-    module = EntropyModule()
+    # Make PPI tensor, kept sparse so only nonzero edges are stored
+    ppi_tensor = spmatrix_to_sparsetensor(ppi.X, dtype = getattr(torch, precision))
+    
+    # Create entropy module holding the PPI, moved to device once
+    module = EntropyModule(ppi_tensor, max_entropy).to(device)
 
     # Assign to devices if available
     module = torch.nn.DataParallel(module, device_ids=[0])
     
-    # Make PPI tensor
-    ppi_tensor = torch.tensor(ppi.X.toarray()).to(device)
-    
-    # Buffer to hold scores
-    entropy_scores = []
+    # Preallocated buffer to hold scores, including padded cells, kept on device
+    # to avoid a host sync every batch
+    entropy_scores = torch.empty(len(dataset) * batch_size, dtype = torch.float32, device = device)
 
     # Create a progressbar to monitor progress
     with tqdm(total=len(dataloader), unit='batch') as pbar:
@@ -124,19 +155,19 @@ def score(
         for i, batch in enumerate(dataloader):
 
             # Push batch into target device
-            batch = batch.to(device)
+            batch = batch.to(device, dtype = ppi_tensor.dtype, non_blocking = True)
 
             # Compute entropy
-            entropy = module(batch, ppi_tensor, max_entropy)
+            entropy = module(batch)
 
-            # Add to results buffer
-            entropy_scores.append(entropy.cpu().numpy())
+            # Write into results buffer
+            entropy_scores[i * batch_size : (i + 1) * batch_size] = entropy.reshape(-1)
 
             # Update progressbar
             pbar.update()
     
-    # Merge scores
-    entropy_scores = np.concatenate(entropy_scores)
+    # Drop padded cells and copy scores back to host once
+    entropy_scores = entropy_scores[:data.n_obs].cpu().numpy()
     
     # Add key
     data_orig.obs[key_added] = entropy_scores
@@ -5,18 +5,22 @@
 # ###################################################################################################
 
 from typing import Union, Tuple, Iterable
+from functools import lru_cache
 
 from anndata import AnnData, read_h5ad
 import scipy.sparse.linalg as la
-from scipy.sparse import issparse
+from scipy.sparse import issparse, spmatrix
+from scipy.sparse.csgraph import connected_components
 
-import networkx as nx
 import numpy as np
 import pandas as pd
 import scanpy as sc
+import torch
+import hashlib
 import os
 
 
+@lru_cache(maxsize=4)
 def load_ppi(
     ppi : str
 ) -> AnnData:
@@ -24,6 +28,7 @@ def load_ppi(
     Load PPI
     
     Loads a protein-protein interaction dataset based on string identifier.
+    Loaded datasets are cached and shared, so they should not be modified.
     
     Params
     -------
@@ -72,24 +77,24 @@ def preprocess(
         intersect with the input data matrix.
     """
     
-    # Find common gene intersection between the two objects
-    common_genes = pd.Index(np.intersect1d(data.var_names, ppi.var_names))
+    # Find common gene intersection between the two objects using hashing
+    common_genes = data.var_names.intersection(ppi.var_names)
     
     # Ensure that there is sufficient overlap
     assert len(common_genes) > 1000, "Low number of genes overlapping reference PPI and target data"
     
-    # Re-index keeping only common genes
-    ppi = ppi[common_genes, common_genes]
-    data = data[:, common_genes]
+    # Re-index keeping only common genes, by integer position
+    ppi_idx = ppi.var_names.get_indexer(common_genes)
+    ppi = ppi[ppi_idx, ppi_idx]
+    data = data[:, data.var_names.get_indexer(common_genes)]
     
-    # use networkX to find the largest connected subgraph
-    gr = nx.Graph(zip(ppi.X.tocoo().row, ppi.X.tocoo().col))
-    gr = nx.relabel_nodes(gr, dict(enumerate(ppi.var_names)))
-    largest_clust_genes = sorted(max(nx.connected_components(gr), key=len))
+    # Label connected components directly on the sparse matrix and find the largest
+    _, labels = connected_components(ppi.X, directed=False)
+    keep_idx = np.flatnonzero(labels == np.bincount(labels).argmax())
     
-    # Re-index keeping only largest cluster genes
-    ppi = ppi[largest_clust_genes, largest_clust_genes]
-    data = data[:, largest_clust_genes].copy()
+    # Re-index keeping only largest cluster genes, both objects follow the data's gene order
+    ppi = ppi[keep_idx, keep_idx]
+    data = data[:, keep_idx].copy()
     
     # Intvert data
     if data.X.max() < 30:
@@ -111,7 +116,8 @@ def calc_max_entropy(
     
     Calculates maximal entropy given a PPI matrix as a
     sparse anndata object. Calculated by taking the
-    log of the right real eigenvalue.
+    log of the right real eigenvalue. The PPI is
+    symmetric so the symmetric ARPACK solver is used.
     
     Params
     -------
@@ -124,9 +130,160 @@ def calc_max_entropy(
         Maximum entropy of the given ppi matrix
     """
     
-    # Calculate maximum entropy as log of right real eigenvalue
-    eig_val, _ = la.eigs(ppi.X, k=1, which='LM')    
-    return np.log(float(eig_val.real))
+    # Calculate maximum entropy as log of right real eigenvalue, starting
+    # from the uniform vector which is close to the leading eigenvector
+    n = ppi.n_vars
+    eig_val, _ = la.eigsh(ppi.X, k=1, which='LA', tol=1e-6, v0=np.ones(n) / np.sqrt(n))
+    return float(np.log(eig_val[0]))
+
+
+@lru_cache(maxsize=None)
+def get_device() -> torch.device:
+    """\
+    Get device
+    
+    Returns the device to compute entropy on, the GPU if
+    available else the CPU. The lookup is cached.
+    
+    Returns
+    -------
+    device : torch.device
+        The device to compute on
+    """
+    
+    return torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+
+def get_batch_size(
+    n_genes : int,
+    n_edges : int,
+    device : torch.device,
+    default : int = 8,
+    mem_fraction : float = 0.5
+) -> int:
+    """\
+    Get batch size
+    
+    Estimates the largest batch of cells that fits in free
+    device memory given the size of the PPI. Falls back to
+    the default on CPU.
+    
+    Params
+    -------
+    n_genes
+        Number of genes in the PPI.
+    n_edges
+        Number of nonzero edges in the PPI.
+    device
+        The device entropy is computed on.
+    default
+        Batch size to use when free memory cannot be queried.
+    mem_fraction
+        Fraction of free device memory to use.
+    
+    Returns
+    -------
+    batch_size : int
+        Number of cells per batch
+    """
+    
+    # Free memory can only be queried on the GPU
+    if device.type != 'cuda':
+        return default
+    
+    # Single driver call, no subprocess needed
+    free, _ = torch.cuda.mem_get_info(device)
+    
+    # Rough float32 footprint of one cell, gene-sized and edge-sized intermediates
+    cell_bytes = 4 * (8 * n_genes + 4 * n_edges)
+    
+    return max(1, int(free * mem_fraction) // cell_bytes)
+
+
+def spmatrix_to_sparsetensor(
+    X : spmatrix,
+    dtype : torch.dtype = torch.float32
+) -> torch.Tensor:
+    """\
+    Sparse matrix to sparse tensor
+    
+    Converts a scipy sparse matrix into a coalesced torch
+    sparse COO tensor without densifying it.
+    
+    Params
+    -------
+    X
+        Scipy sparse matrix to convert.
+    dtype
+        Data type of the tensor values.
+        
+    Returns
+    -------
+    tensor : torch.Tensor
+        Sparse COO tensor holding the nonzeros of X
+    """
+    
+    # Canonical CSR (sorted, no duplicates) is already in coalesced order
+    csr = X.tocsr()
+    if not csr.has_canonical_format:
+        csr = csr.copy()
+        csr.sum_duplicates()
+    
+    # Build (row, col) indices directly from CSR into a single preallocated
+    # buffer, row pointers are expanded into row indices
+    indices = np.empty((2, csr.nnz), dtype=np.int64)
+    indices[0] = np.repeat(np.arange(csr.shape[0], dtype=np.int64), np.diff(csr.indptr))
+    indices[1] = csr.indices
+    values = torch.tensor(csr.data, dtype=dtype)
+    
+    return torch.sparse_coo_tensor(torch.from_numpy(indices), values, csr.shape, is_coalesced=True)
+
+
+@lru_cache(maxsize=16)
+def _max_entropy_slot(
+    key : Tuple[str, str]
+) -> list:
+    """\
+    Cache slot holding the maximum entropy computed for a PPI key.
+    """
+    
+    return []
+
+
+def ppi_max_entropy(
+    name : str,
+    ppi : AnnData
+) -> float:
+    """\
+    PPI maximum entropy.
+    
+    Calculates maximal entropy of a preprocessed PPI. Results
+    are cached on the PPI name and its kept genes, so repeated
+    scoring against the same genes skips the eigenvalue
+    computation.
+    
+    Params
+    -------
+    name
+        Name of protein-protein interaction dataset the PPI was loaded from.
+    ppi
+        The preprocessed PPI matrix as an annotated data object.
+    
+    Returns
+    -------
+    max_entropy : float
+        Maximum entropy of the given ppi matrix
+    """
+    
+    # Key on the PPI name and a digest of the kept genes, hashed vectorized
+    genes = pd.util.hash_pandas_object(ppi.var_names, index=False).to_numpy()
+    slot = _max_entropy_slot((name, hashlib.blake2b(genes.tobytes(), digest_size=16).hexdigest()))
+    
+    # Compute from the PPI in hand on a cache miss
+    if not slot:
+        slot.append(calc_max_entropy(ppi))
+    
+    return slot[0]
 
 
 def chunk(